@@ -1,5 +1,7 @@
 import sys
 import time
+import heapq
+import collections
 import seiscomp.client
 import seiscomp.datamodel
 
@@ -21,8 +23,48 @@ global_net_sta_blacklist = [
     ("WA", "ZON"),
 ]
 
+
+# Empty location codes are represented by "--" in the nslc tuples used as
+# keys. These convert between that and the location code used in stream
+# requests and file names.
+def normalized_location(l):
+    return l or "--"
+
+
+def stream_location(l):
+    return "" if l == "--" else l
+
+
+def stream_key(n, s, l, c):
+    """
+    Return the normalized stream nslc and the component of a channel.
+    The codes are interned.
+    """
+    intern = sys.intern
+    nslc = (intern(n), intern(s), intern(normalized_location(l)),
+            intern(c[:-1]))
+    return nslc, c[-1:]
+
+
 class RequestItem:
-    pass
+    __slots__ = (
+        "pick", "pick_id", "nslc", "components", "component_set",
+        "start_time", "end_time", "end_seconds", "expires", "finished")
+
+    def __init__(self, pick, nslc, components, start_time, end_time, expires):
+        self.pick = pick
+        # The pick ID is needed frequently as key and in log messages
+        self.pick_id = pick.publicID()
+        self.nslc = nslc
+        self.components = components
+        # for the completion test in processPendingPicks
+        self.component_set = frozenset(components)
+        self.start_time = start_time
+        self.end_time = end_time
+        self.end_seconds = float(end_time)
+        # The expiry time in seconds as float
+        self.expires = expires
+        self.finished = False
 
 
 class App(seiscomp.client.Application):
@@ -40,8 +82,28 @@ class App(seiscomp.client.Application):
         self.after_p = 240.
         self.expire_after = 1800.
 
+        # All pending requests by pick ID
         self.request = dict()
 
+        # Pending requests not due yet and pending requests by expiry
+        # time, each as a heap of (time, serial, request_item) tuples with
+        # the time as float. The serial number only breaks ties.
+        # Requests that were finished or replaced in the meantime are not
+        # removed from the heaps but skipped when they come up.
+        self.waiting = list()
+        self.expiring = list()
+        self.request_serial = 0
+
+        # Pending requests that are due, by pick ID
+        self.due = dict()
+
+        # Maps the raw nslc of a record to the normalized stream nslc and
+        # the component, so that this is done only once per stream.
+        self.stream_keys = dict()
+
+    def isPending(self, request_item):
+        return self.request.get(request_item.pick_id) is request_item
+
     def init(self):
         if not super().init():
             return False
@@ -53,19 +115,36 @@ class App(seiscomp.client.Application):
             self.inventory, now,
             net_sta_blacklist=global_net_sta_blacklist)
 
+        # The time spans needed for each pick
+        self.before_p_span = seiscomp.core.TimeSpan(-self.before_p)
+        self.after_p_span = seiscomp.core.TimeSpan(+self.after_p)
+
         return True
 
 
     def processPendingPicks(self):
         now = seiscomp.core.Time.GMT()
-        def pt(p):
-            return p.time().value()
+        t_now = float(now)
 
-        request_items_due = [
-                i for i in self.request.values()
-                if float(now - pt(i.pick)) > self.after_p ]
+        # Nothing to do until the next request becomes due or expires
+        if not self.due and \
+           (not self.waiting or self.waiting[0][0] >= t_now) and \
+           (not self.expiring or self.expiring[0][0] >= t_now):
+            return
+
+        while self.waiting and self.waiting[0][0] < t_now:
+            request_item = heapq.heappop(self.waiting)[2]
+            if self.isPending(request_item):
+                self.due[request_item.pick_id] = request_item
+
+        request_items_due = list(self.due.values())
         seiscomp.logging.debug("picks due %d" % (len(request_items_due),))
 
+        if not request_items_due:
+            # Nothing to request, but pending requests may still expire
+            self.processExpiredPicks(t_now, dict())
+            return
+
         # This is a brute-force request: Try and see what we get.
         #
         # If the requested data is not complete yet, the request will be
@@ -77,38 +156,48 @@ class App(seiscomp.client.Application):
         stream.setTimeout(stream_timeout)
         stream_count = 0
 
+        # The due requests by nslc. There may be more than one request
+        # per nslc.
+        due_by_nslc = collections.defaultdict(list)
+
         for request_item in request_items_due:
+            due_by_nslc[request_item.nslc].append(request_item)
+
             n, s, l, c = request_item.nslc
             t1 = request_item.start_time
             t2 = request_item.end_time
             for comp in request_item.components:
-                stream.addStream(n, s, "" if l == "--" else l, c+comp, t1, t2)
+                stream.addStream(n, s, stream_location(l), c+comp, t1, t2)
                 stream_count += 1
 
-        waveforms = dict()
-        end_time = dict()
+        waveforms = collections.defaultdict(list)
+        # Latest record end time per nslc and component, in seconds as
+        # float to avoid creating and comparing Time objects per record.
+        end_time = collections.defaultdict(dict)
 
         seiscomp.logging.info(
             "RecordStream: requesting %d streams" % stream_count)
         count = 0
-        for rec in scstuff.util.RecordIterator(stream, showprogress=True):
+        # The progress display is only useful if someone is watching
+        showprogress = sys.stderr.isatty()
+        stream_keys = self.stream_keys
+        get_nslc = scstuff.util.nslc
+        for rec in scstuff.util.RecordIterator(stream, showprogress=showprogress):
             if rec is None:
                 break
-            nslc = scstuff.util.nslc(rec)
+            nslc = get_nslc(rec)
             # "raw" nslc
-            if nslc not in waveforms:
-                waveforms[nslc] = []
             waveforms[nslc].append(rec)
 
-            n, s, l, c = nslc
-            c, comp = c[:-1], c[-1]
-            nslc = n, s, "--" if l=="" else l, c
-            if nslc not in end_time:
-                end_time[nslc] = dict()
-            if comp not in end_time[nslc]:
-                end_time[nslc][comp] = rec.endTime()
-            if rec.endTime() > end_time[nslc][comp]:
-                    end_time[nslc][comp] = rec.endTime()
+            key = stream_keys.get(nslc)
+            if key is None:
+                key = stream_keys[nslc] = stream_key(*nslc)
+            nslc, comp = key
+            comp_end_time = end_time[nslc]
+            rec_end_time = float(rec.endTime())
+            previous = comp_end_time.get(comp)
+            if previous is None or rec_end_time > previous:
+                comp_end_time[comp] = rec_end_time
             count += 1
 
         seiscomp.logging.debug(
@@ -118,77 +207,96 @@ class App(seiscomp.client.Application):
         seiscomp.logging.debug(
             "RecordStream: request lasted %.3f seconds" % (dt))
 
+        # Only requests that are due have been requested, and of these
+        # only the ones for streams from which we received records can be
+        # finished.
         finished_request_items = []
-        for pickID in self.request:
-            request_item = self.request[pickID]
-            finished = True
-            if request_item.nslc in end_time:
-                for comp in request_item.components:
-                    if request_item.nslc not in end_time:
-                        # No record received (yet) for requested stream
-                        finished = False
-                        break
-                    if comp not in end_time[request_item.nslc]:
-                        # No record received (yet) for requested component
-                        finished = False
-                        break
-                    if end_time[request_item.nslc][comp] < request_item.end_time:
-                        # if *any* of the components is unfinished
-                        finished = False
-                        break
-                if finished:
-                    request_item.finished = True
-
-            if request_item.finished:
+        for nslc in end_time:
+            if nslc not in due_by_nslc:
+                continue
+            comp_end_time = end_time[nslc]
+            for request_item in due_by_nslc[nslc]:
+                if not request_item.component_set.issubset(comp_end_time):
+                    # No record received (yet) for a requested component
+                    continue
+                if not all(
+                        comp_end_time[comp] >= request_item.end_seconds
+                        for comp in request_item.component_set):
+                    # if *any* of the components is unfinished
+                    continue
+                request_item.finished = True
                 finished_request_items.append(request_item)
 
         for request_item in finished_request_items:
-            pickID = request_item.pick.publicID()
+            pickID = request_item.pick_id
             seiscomp.logging.debug("%s finished" % (pickID,))
             del self.request[pickID]
-
-        expired_request_items = [
-            i for i in self.request.values()
-            if now > i.expires]
-        for request_item in expired_request_items:
-            pickID = request_item.pick.publicID()
+            del self.due[pickID]
+
+        self.processExpiredPicks(t_now, end_time)
+
+    def processExpiredPicks(self, t_now, end_time):
+        """
+        Remove the requests that expired before t_now (as float).
+
+        end_time holds the end times of the data received in the last
+        request, which are logged for the expired requests.
+        """
+        while self.expiring and self.expiring[0][0] < t_now:
+            request_item = heapq.heappop(self.expiring)[2]
+            if not self.isPending(request_item):
+                continue
+            pickID = request_item.pick_id
             seiscomp.logging.debug("%s expired" % (pickID,))
             for comp in request_item.components:
-                if comp not in end_time[request_item.nslc]:
+                if request_item.nslc not in end_time or \
+                   comp not in end_time[request_item.nslc]:
                     seiscomp.logging.debug("  %s no data" % (comp,))
                     continue
-                t2 = end_time[request_item.nslc][comp]
+                t2 = seiscomp.core.Time(end_time[request_item.nslc][comp])
                 t2 = scstuff.util.isotimestamp(t2)
                 seiscomp.logging.debug("  %s %s" % (comp, t2))
             del self.request[pickID]
+            if pickID in self.due:
+                del self.due[pickID]
 
         seiscomp.logging.debug("%d pending request items" % (len(self.request)))
 
     def processPick(self, pick):
-        seiscomp.logging.debug("pick %s" % (pick.publicID(),))
         pickID = pick.publicID()
+        seiscomp.logging.debug("pick %s" % (pickID,))
         n, s, l, c = scstuff.util.nslc(pick.waveformID())
-
-        nslc = (n, s, "--" if l=="" else l, c[:2])
+        if not c:
+            seiscomp.logging.debug(
+                "skipping pick %s without channel code" % (pickID,))
+            return
+        nslc, comp = stream_key(n, s, l, c)
 
         t0 = pick.time().value()
-        t1 = t0 + seiscomp.core.TimeSpan(-self.before_p)
-        t2 = t0 + seiscomp.core.TimeSpan(+self.after_p)
+        t1 = t0 + self.before_p_span
+        t2 = t0 + self.after_p_span
         if nslc not in self.components:
             # This may occur if a station was (1) blacklisted or (2) added
             # to the processing later on. Either way we skip this pick.
             return
 
-        now = seiscomp.core.Time.GMT()
-        request_item = RequestItem()
-        request_item.expires = now + seiscomp.core.TimeSpan(self.expire_after)
-        request_item.pick = pick
-        request_item.nslc = nslc
-        request_item.components = self.components[nslc]
-        request_item.start_time = t1
-        request_item.end_time = t2
-        request_item.finished = False
+        now = float(seiscomp.core.Time.GMT())
+        request_item = RequestItem(
+            pick, nslc, self.components[nslc], t1, t2,
+            now + self.expire_after)
         self.request[pickID] = request_item
+        if pickID in self.due:
+            # replaces an earlier request for the same pick
+            del self.due[pickID]
+
+        # A request is due once its time window has passed
+        self.request_serial += 1
+        heapq.heappush(
+            self.waiting,
+            (request_item.end_seconds, self.request_serial, request_item))
+        heapq.heappush(
+            self.expiring,
+            (request_item.expires, self.request_serial, request_item))
 
     def handleTimeout(self):
         # The timeout interval can be configured via timeout_interval
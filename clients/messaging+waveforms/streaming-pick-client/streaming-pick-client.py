@@ -1,6 +1,11 @@
 import sys
 import time
+import collections
+import heapq
+import os
 import pathlib
+import queue
+import threading
 import seiscomp.client
 import seiscomp.datamodel
 import seiscomp.io
@@ -17,11 +22,101 @@ global_net_sta_blacklist = [
 ]
 
 
+# Empty location codes are represented by "--" in the nslc tuples used as
+# keys. These convert between that and the location code used in stream
+# requests and file names.
+def normalized_location(l):
+    return l or "--"
+
+
+def stream_location(l):
+    return "" if l == "--" else l
+
+
+def stream_key(n, s, l, c):
+    """
+    Return the normalized stream nslc and the component of a channel.
+    The codes are interned.
+    """
+    intern = sys.intern
+    nslc = (intern(n), intern(s), intern(normalized_location(l)),
+            intern(c[:-1]))
+    return nslc, c[-1:]
+
+
 class RequestItem:
-    def __init__(self):
+    __slots__ = (
+        "pick", "pick_id", "nslc", "components", "start_time", "end_time",
+        "start_seconds", "end_seconds", "expires", "data", "fetched",
+        "finished")
+
+    def __init__(self, pick, nslc, components, start_time, end_time, expires):
+        self.pick = pick
+        # The pick ID is needed frequently as key and in log messages
+        self.pick_id = pick.publicID()
+        self.nslc = nslc
+        self.components = components
+        self.start_time = start_time
+        self.end_time = end_time
+        # The time window as float for comparisons with the buffer times
+        self.start_seconds = float(start_time)
+        self.end_seconds = float(end_time)
+        # The expiry time in seconds as float
+        self.expires = expires
+        # One record list per component, filled either from the stream
+        # buffer or from the archive.
+        self.data = { comp: list() for comp in components }
+        # Whether the data were fetched from the archive already
+        self.fetched = False
         self.finished = False
 
 
+class StreamBuffer:
+    """
+    Waveform buffer and acquisition status of one stream
+    """
+    __slots__ = ("records", "end_time", "min_end_time", "next_cleanup")
+
+    def __init__(self, next_cleanup):
+        # The components stored in separate deques. Records arrive in
+        # time order, so trimming the buffer only ever removes records
+        # from the left end.
+        # The deques hold (start_time, end_time, record) tuples so that
+        # the record times need to be retrieved only once per record.
+        # All times in the buffer are float seconds, which are much
+        # cheaper to compare than Time objects.
+        self.records = collections.defaultdict(collections.deque)
+
+        # Latest end time per component
+        self.end_time = dict()
+
+        # End time of the least advanced component. This is the time up
+        # to which the data of the stream are complete. None until the
+        # first record was received.
+        self.min_end_time = None
+
+        # When to trim the buffer next, in terms of time.monotonic()
+        self.next_cleanup = next_cleanup
+
+    def extract(self, comp, start_time, end_time):
+        """
+        Return the records of a component overlapping the time window.
+
+        The buffer is searched backwards from the most recent record, as
+        requested time windows are usually close to the end of the buffer.
+        The search stops at the first record ending before start_time.
+        """
+        records = list()
+        for t1, t2, rec in reversed(self.records[comp]):
+            if t1 > end_time:
+                continue
+            if t2 < start_time:
+                break
+            records.append(rec)
+        records.reverse()
+        return records
+
+
 class BufferingStreamApplication(seiscomp.client.StreamApplication):
     """
     StreamApplication which streams continuous waveform data and buffers
@@ -42,17 +137,40 @@ class BufferingStreamApplication(seiscomp.client.StreamApplication):
         self.buffer_length = 3600.
 
         # This is the waveform buffer.
-        # There is one dict per stream, with the stream's nslc used as key.
-        # Each item is another dict with the components stored in separate lists.
+        # There is one StreamBuffer per stream, with the stream's nslc used
+        # as key, for all the streams we acquire. Records of other streams
+        # are ignored.
         self.buffer = dict()
-        self.end_time = dict()
 
+        # Maps the stream ID of a record to the normalized stream nslc and
+        # the component. The same nslc tuple is thus used for all records
+        # of a stream and the normalization is done only once per stream.
+        self.stream_keys = dict()
+
+        # Each stream buffer is trimmed every cleanup_interval seconds when
+        # one of its records is received. The cleanup is scheduled using
+        # the monotonic clock, which is much cheaper to read for every
+        # record than Time.GMT().
         self.cleanup_interval = 120.
-        self.next_cleanup = Time.GMT() + TimeSpan(self.cleanup_interval)
 
     def setBufferLength(self, seconds):
         self.buffer_length = seconds
 
+    def streamKey(self, rec):
+        """
+        Return the normalized stream nslc and the component of a record,
+        see stream_key().
+        """
+        # The stream ID is a single string and thus cheaper to retrieve and
+        # look up than the four codes.
+        stream_id = rec.streamID()
+        key = self.stream_keys.get(stream_id)
+        if key is None:
+            key = self.stream_keys[stream_id] = stream_key(
+                rec.networkCode(), rec.stationCode(),
+                rec.locationCode(), rec.channelCode())
+        return key
+
     def handleRecord(self, rec):
         """
         Virtual record handler that we implement here to store
@@ -62,56 +180,75 @@ class BufferingStreamApplication(seiscomp.client.StreamApplication):
         # This hack is required in order to acquire the ownership
         # of the record and also increase the reference count by 1.
         rec = seiscomp.core.Record.Cast(rec)
-        nslc = scstuff.util.nslc(rec)
-        n, s, l, c = nslc
-        if l == "":
-            l = "--"   # TODO: Review!
-        c, comp = c[:-1], c[-1]
-        nslc = n, s, l, c
-
-        # Find the right buffer
-        if nslc not in self.buffer:
-            # create a buffer for this stream
-            self.buffer[nslc] = dict()
-        if comp not in self.buffer[nslc]:
-            self.buffer[nslc][comp] = list()
+        nslc, comp = self.streamKey(rec)
+        stream = self.buffer.get(nslc)
+        if stream is None:
+            return
+
+        start_time = float(rec.startTime())
+        end_time = float(rec.endTime())
+
         # Store record
-        self.buffer[nslc][comp].append(rec)
+        stream.records[comp].append((start_time, end_time, rec))
 
         # Update end time for this stream
-        if nslc not in self.end_time:
-            self.end_time[nslc] = dict()
-        if comp not in self.end_time[nslc]:
-            self.end_time[nslc][comp] = rec.endTime()
-        if rec.endTime() > self.end_time[nslc][comp]:
-            self.end_time[nslc][comp] = rec.endTime()
+        stream_end_time = stream.end_time
+        previous = stream_end_time.get(comp)
+        if previous is None:
+            stream_end_time[comp] = end_time
+            # A new component can only lower the minimum
+            if stream.min_end_time is None:
+                stream.min_end_time = end_time
+                self.handleStreamProgress(nslc)
+            elif end_time < stream.min_end_time:
+                stream.min_end_time = end_time
+        elif end_time > previous:
+            stream_end_time[comp] = end_time
+            # Only if the least advanced component moved forward the
+            # minimum needs to be recomputed.
+            if previous == stream.min_end_time:
+                stream.min_end_time = min(stream_end_time.values())
+                if stream.min_end_time > previous:
+                    self.handleStreamProgress(nslc)
+
+        now = time.monotonic()
+        if now >= stream.next_cleanup:
+            self.cleanup_stream(nslc)
+            stream.next_cleanup = now + self.cleanup_interval
 
-        self.cleanup_all()
+    def handleStreamProgress(self, nslc):
+        """
+        Called whenever the min_end_time of a stream has advanced, i.e.
+        whenever its data are complete up to a later time than before.
 
-    def cleanup_stream(self, nslc):
-        end_time = None
-        for comp in self.buffer[nslc]:
-            t = self.buffer[nslc][comp][-1].endTime()
-            if end_time is None or t < end_time:
-                end_time = t
-        start_time = end_time - TimeSpan(self.buffer_length)
-        for comp in self.buffer[nslc]:
-            buf = self.buffer[nslc][comp]
-            self.buffer[nslc][comp] = [
-                    r for r in buf
-                    if r.endTime() > start_time ]
-
-    def cleanup_all(self):
-        """ Trim all the waveform buffers """
-        now = Time.GMT()
+        Does nothing here. Derived classes can implement it to act on
+        newly available data without checking on every record.
+        """
+        pass
 
-        if now < self.next_cleanup:
+    def cleanup_stream(self, nslc):
+        """
+        Trim the buffers of one stream to buffer_length seconds before
+        the end time of the most advanced component.
+
+        Trimming relative to the most advanced component bounds the
+        buffers by time even if one of the components stops delivering
+        data. Unlike a bound on the number of records, it doesn't depend
+        on the record durations.
+
+        Records are stored in time order, so the expired records are
+        always at the head of each buffer and the trim stops at the first
+        record still needed. The cost is proportional to the number of
+        expired records, not to the buffer size.
+        """
+        stream = self.buffer[nslc]
+        if stream.min_end_time is None:
+            # nothing received yet
             return
-
-        for nslc in self.buffer:
-            self.cleanup_stream(nslc)
-
-        self.next_cleanup = now + TimeSpan(self.cleanup_interval)
+        start_time = max(stream.end_time.values()) - self.buffer_length
+        for buf in stream.records.values():
+            while buf and buf[0][1] <= start_time:
+                buf.popleft()
 
     def init(self):
         if not super().init():
@@ -121,7 +258,7 @@ class BufferingStreamApplication(seiscomp.client.StreamApplication):
 
         configModule = self.configModule()
         self.configuredStreams = \
-            scstuff.util.configuredStreams(self.configModule(), self.name())
+            scstuff.util.configuredStreams(configModule, self.name())
 
         now = Time.GMT()
         self.components = scstuff.inventory.streamComponents(
@@ -131,16 +268,31 @@ class BufferingStreamApplication(seiscomp.client.StreamApplication):
         # start acquisition one hour ago
         tstart = now + TimeSpan(-3600)
 
-        self.recordStream().setTimeout(300)
-        self.recordStream().setStartTime(tstart)
+        recordStream = self.recordStream()
+        recordStream.setTimeout(300)
+        recordStream.setStartTime(tstart)
 
+        acquired_streams = list()
+        addStream = recordStream.addStream
         for nslc in self.configuredStreams:
-            if nslc not in self.components:
+            components = self.components.get(nslc)
+            if components is None:
                 seiscomp.logging.debug("skipping %s" % (str(nslc),))
                 continue
             n, s, l, c = nslc
-            for comp in self.components[nslc]:
-                self.recordStream().addStream(n, s, "" if l == "--" else l, c+comp)
+            l = stream_location(l)
+            for comp in components:
+                addStream(n, s, l, c+comp)
+            # The buffer keys share their strings with the keys from
+            # stream_key()
+            acquired_streams.append(tuple(sys.intern(code) for code in nslc))
+
+        # Spread the first cleanups of the streams evenly over the cleanup
+        # interval so that the cleanups don't all take place at once.
+        t0 = time.monotonic()
+        for i, nslc in enumerate(acquired_streams):
+            offset = self.cleanup_interval * (i+1) / len(acquired_streams)
+            self.buffer[nslc] = StreamBuffer(t0 + offset)
 
         return True
 
@@ -176,17 +328,47 @@ class PickWaveformDumperApp(BufferingStreamApplication):
         # Requests accessible by nslc.
         # At any point in time there may be more than one request pending
         # for the same nslc so each item in the dict is itself a list.
-        self.request_by_nslc = dict()
+        # The list is a heap of (end_time, serial, request_item) tuples,
+        # with the end time as float, so that the request that completes
+        # first is always at the top. The serial number only breaks ties.
+        # Only streams with pending requests are in the dict, so that the
+        # progress of all other streams is dismissed with one lookup.
+        self.request_by_nslc = collections.defaultdict(list)
+        self.request_serial = 0
+        # Total number of requests in request_by_nslc
+        self.request_by_nslc_count = 0
+
+        # Requests for which the data have to be fetched from the archive.
+        # These are collected and sent as one request every
+        # archive_flush_interval seconds rather than one request per pick.
+        self.archive_pending = collections.deque()
+        self.archive_flush_interval = 5
+
+        # Reused for each pick written to XML. The pick is only added to
+        # the EventParameters while it is written.
+        self.xml_archive = seiscomp.io.XMLArchive()
+        self.xml_archive.setFormattedOutput(True)
+        self.xml_ep = seiscomp.datamodel.EventParameters()
+
+        # Picks to be written to XML as (file name, pick) pairs. These are
+        # written in one go from handleTimeout rather than one at a time
+        # from within the record handling.
+        self.xml_pending = list()
+
+        # The MiniSEED files are written by a background thread so that
+        # writing them does not hold up the record acquisition. The queue
+        # is bounded in order to limit the memory held by pending writes.
+        self.write_queue = queue.Queue(maxsize=100)
+        self.write_thread = None
 
     def createCommandLineDescription(self):
         super().createCommandLineDescription()
 
-        self.commandline().addGroup("Config")
-        self.commandline().addStringOption(
+        commandline = self.commandline()
+        commandline.addGroup("Config")
+        commandline.addStringOption(
             "Config", "export-dir,d", "path of the export directory")
-
-        self.commandline().addGroup("Config")
-        self.commandline().addStringOption(
+        commandline.addStringOption(
             "Config", "archive-input", "URL of the waveform data archive")
 
     def validateParameters(self):
@@ -196,8 +378,10 @@ class PickWaveformDumperApp(BufferingStreamApplication):
         if not super().validateParameters():
             return False
 
+        commandline = self.commandline()
+
         try:
-            self.export_d = self.commandline().optionString("export-dir")
+            self.export_d = commandline.optionString("export-dir")
         except RuntimeError:
             self.export_d = None
 
@@ -205,7 +389,7 @@ class PickWaveformDumperApp(BufferingStreamApplication):
             self.export_d = pathlib.Path(self.export_d).expanduser()
 
         try:
-            self.archive_input = self.commandline().optionString("archive-input")
+            self.archive_input = commandline.optionString("archive-input")
         except RuntimeError:
             self.archive_input = None
 
@@ -216,15 +400,83 @@ class PickWaveformDumperApp(BufferingStreamApplication):
             return False
         
         if self.export_d is not None and self.export_d.exists():
+            # continue with the export directory numbering
             try:
-                # continue with the export directory numbering
-                last = sorted(self.export_d.glob("0*"))[-1].name
-                self.request_item_count = int(last)
-            except IndexError:
-                self.request_item_count = 0
+                self.request_item_count = int(
+                    (self.export_d / ".counter").read_text())
+            except (OSError, ValueError):
+                # No (valid) counter file, e.g. if written by an older
+                # version. Find the last directory instead. scandir only
+                # reads the directory, without a Path object per entry.
+                with os.scandir(self.export_d) as entries:
+                    last = max(
+                        (e.name for e in entries if e.name.startswith("0")),
+                        default=None)
+                if last is None:
+                    self.request_item_count = 0
+                else:
+                    self.request_item_count = int(last)
+
+        if self.export_d is not None:
+            self.write_thread = threading.Thread(target=self.writeFiles)
+            self.write_thread.start()
+
+        # The time spans needed for each pick
+        self.before_p_span = TimeSpan(-self.before_p)
+        self.after_p_span = TimeSpan(+self.after_p)
 
         return True
 
+    def done(self):
+        # Don't drop the archive requests of the last few seconds
+        self.flushArchiveRequests()
+        self.flushPickXML()
+
+        if self.write_thread is not None:
+            # let the writer finish the pending files
+            self.write_queue.put(None)
+            self.write_thread.join()
+            self.write_thread = None
+
+        super().done()
+
+    def writeFiles(self):
+        """
+        Write the files queued in write_queue until None is received.
+
+        Runs in the background thread. The queued items are tuples of
+        file name, the bytes to write and whether to overwrite an
+        existing file. The directory is created if needed.
+        """
+        while True:
+            item = self.write_queue.get()
+            if item is None:
+                break
+            filename, data, overwrite = item
+            try:
+                filename.parent.mkdir(parents=True, exist_ok=True)
+                with open(filename, "wb" if overwrite else "xb") as f:
+                    f.write(data)
+            except FileExistsError:
+                continue
+            except Exception as e:
+                # Keep the thread alive whatever happens, otherwise the
+                # queue would fill up and block processData for good.
+                seiscomp.logging.error(
+                    "Failed to write %s: %s" % (filename, e))
+
+    def writeCounter(self, filename, count):
+        """
+        Write the number of the last export directory to the counter file,
+        from which the numbering is continued after a restart.
+
+        The file is replaced atomically so that it is never found empty.
+        """
+        filename.parent.mkdir(parents=True, exist_ok=True)
+        tmp = filename.with_name(filename.name + ".tmp")
+        tmp.write_text("%d\n" % count)
+        tmp.replace(filename)
+
     def fetchArchiveData(self, request):
         """
         Fetch older data from the upstream server using a non-streaming
@@ -235,110 +487,122 @@ class PickWaveformDumperApp(BufferingStreamApplication):
         a secondary data source like our archive using a separate request.
 
         The argument can be a single RequestItem or a list thereof.
+
+        A RecordStream cannot be reused once it has been read to the end,
+        so each call opens one stream for all the items passed. Callers
+        should therefore pass as many items as possible at once.
         """
         if isinstance(request, list):
             request_items = request
         else:
             request_items = [ request ]
 
-        request_items_by_nslc = {item.nslc: item for item in request_items}
+        if not request_items:
+            return
+
+        # There may be more than one request item per nslc
+        request_items_by_nslc = collections.defaultdict(list)
+        for request_item in request_items:
+            request_items_by_nslc[request_item.nslc].append(request_item)
 
         stream_timeout = 5
         stream_count = 0
         stream = seiscomp.io.RecordStream.Open(self.archive_input)
+        if stream is None:
+            seiscomp.logging.error(
+                "Failed to open RecordStream %s" % (self.archive_input,))
+            return
         stream.setTimeout(stream_timeout)
         for request_item in request_items:
+            # The archive data replace whatever the item held before, e.g.
+            # incomplete data from the stream buffer.
+            for comp in request_item.components:
+                request_item.data[comp] = list()
             n, s, l, c = request_item.nslc
             t1 = request_item.start_time
             t2 = request_item.end_time
             for comp in request_item.components:
-                stream.addStream(n, s, "" if l == "--" else l, c+comp, t1, t2)
+                stream.addStream(n, s, stream_location(l), c+comp, t1, t2)
                 stream_count += 1
         seiscomp.logging.info(
             "RecordStream: requesting %d streams" % stream_count)
         count = 0
 
-        for request_item in request_items:
-            try:
-                # FIXME temp hack
-                request_item.data
-            except AttributeError:
-                # it's probably OK to start with empty data anyway
-                request_item.data = dict()
-            for comp in request_item.components:
-                if comp not in request_item.data:
-                    request_item.data[comp] = list()
-
-        for rec in scstuff.util.RecordIterator(stream, showprogress=True):
+        # The progress display is only useful if someone is watching
+        showprogress = sys.stderr.isatty()
+        streamKey = self.streamKey
+        for rec in scstuff.util.RecordIterator(stream, showprogress=showprogress):
             if rec is None:
                 break
 
-            nslc = scstuff.util.nslc(rec)
-            n, s, l, c = nslc
-            if l == "":
-                l = "--"   # TODO: Review!
-            c, comp = c[:-1], c[-1]
-            nslc = n, s, l, c
+            nslc, comp = streamKey(rec)
 
-            request_item = request_items_by_nslc[nslc]
-            request_item.data[comp].append(rec)
+            rec_start_time = float(rec.startTime())
+            rec_end_time = float(rec.endTime())
+            for request_item in request_items_by_nslc[nslc]:
+                if rec_end_time   >= request_item.start_seconds and \
+                   rec_start_time <= request_item.end_seconds:
+                    request_item.data[comp].append(rec)
             count += 1
 
         for request_item in request_items:
+            request_item.fetched = True
             request_item.finished = True
 
         seiscomp.logging.debug("RecordStream: received %d records" % (count,))
 
-    def handleRecord(self, rec):
+    def flushArchiveRequests(self):
         """
-        Virtual record handler that we implement here to store
-        the data in ring buffers.
+        Fetch the data for all pending archive requests in one go.
         """
+        if not self.archive_pending:
+            return
 
-        super().handleRecord(rec)
+        self.fetchArchiveData(list(self.archive_pending))
 
-        # This hack is required in order to acquire the ownership
-        # of the record and also increase the reference count by 1.
-        rec = seiscomp.core.Record.Cast(rec)
-        nslc = scstuff.util.nslc(rec)
-        n, s, l, c = nslc
-        if l == "":
-            l = "--"   # TODO: Review!
-        c, comp = c[:-1], c[-1]
-        nslc = n, s, l, c
-
-        if nslc not in self.request_by_nslc:
+        # The items stay in archive_pending until processed to keep the
+        # request bookkeeping consistent.
+        while self.archive_pending:
+            request_item = self.archive_pending.popleft()
+            self.processData(request_item)
+
+    def handleStreamProgress(self, nslc):
+        """
+        Complete the pending requests of a stream for which all data are
+        now in the buffer.
+        """
+
+        heap = self.request_by_nslc.get(nslc)
+        if heap is None:
             # Nothing to do
             return
 
-        # See if a data request for this stream is complete
-        for request_item in self.request_by_nslc[nslc]:
-            finished = True
-            for comp in self.end_time[nslc]:
-                if self.end_time[nslc][comp] < request_item.end_time:
-                    finished = False
-                    break
-            if not finished:
-                continue
+        # See if a data request for this stream is complete. The requests
+        # are ordered by end time, so we can stop at the first request
+        # that is not complete.
+        stream = self.buffer[nslc]
+        while heap and heap[0][0] <= stream.min_end_time:
+            request_item = heap[0][2]
 
             request_item.finished = True
-            request_item.data = dict()
-            for comp in self.buffer[nslc]:
-                request_item.data[comp] = [
-                    r for r in self.buffer[nslc][comp]
-                    if r.endTime()   >= request_item.start_time and \
-                       r.startTime() <= request_item.end_time]
+            for comp in stream.records:
+                request_item.data[comp] = stream.extract(
+                    comp, request_item.start_seconds, request_item.end_seconds)
 
+            heapq.heappop(heap)
+            self.request_by_nslc_count -= 1
             self.processData(request_item)
 
-            self.request_by_nslc[request_item.nslc].remove(request_item)
-            del self.request[request_item.pick.publicID()]
-
-        self.cleanup_all()
+        if not heap:
+            del self.request_by_nslc[nslc]
 
     def processData(self, request_item):
-        seiscomp.logging.info("Working with " + request_item.pick.publicID())
+        """
+        Export the data of a finished request and remove the request.
 
+        Requests with incomplete data from the stream buffer are instead
+        passed on to the next archive request.
+        """
         incomplete = False
         for comp in request_item.components:
             if comp not in request_item.data:
@@ -347,93 +611,107 @@ class PickWaveformDumperApp(BufferingStreamApplication):
             if not request_item.data[comp]:
                 incomplete = True
 
-        if incomplete:
-            # re-fetch data from server
-            self.fetchArchiveData(request_item)
+        if incomplete and not request_item.fetched:
+            # Re-fetch the data from the server, unless that's where they
+            # already came from. This is done with the next archive
+            # request rather than with a RecordStream per request.
+            self.archive_pending.append(request_item)
+            return
+
+        del self.request[request_item.pick_id]
+        seiscomp.logging.info("Working with " + request_item.pick_id)
 
         if self.export_d is not None:
             overwrite = False
 
             self.request_item_count += 1
+
+            # The counter is updated before any file of the directory is
+            # written, here in the main thread. If the application is
+            # stopped in between, a number may be skipped after a restart
+            # but never be used twice.
+            try:
+                self.writeCounter(
+                    self.export_d / ".counter", self.request_item_count)
+            except OSError as e:
+                seiscomp.logging.error(
+                    "Failed to write the export counter: %s" % (e,))
+
+            # The directory is created when the first file is written
             path = self.export_d / ("%09d" % self.request_item_count)
-            path.mkdir(parents=True, exist_ok=True)
             n, s, l, c = request_item.nslc
-            basename = "%s.%s.%s.%s" % (n, s, "" if l=="--" else l, c)
+            basename = "%s.%s.%s.%s" % (n, s, stream_location(l), c)
             for comp in request_item.components:
                 if not comp in request_item.data:
                     continue
                 mseed_filename = path / (basename + comp + ".mseed")
-                if mseed_filename.exists() and not overwrite:
-                    continue
                 if not request_item.data[comp]:
                     continue
-                with open(mseed_filename, "wb") as f:
-                    for rec in request_item.data[comp]:
-                        f.write(rec.raw().str())
+                # Write all records of the component at once. The data
+                # are copied here, the file is written in the background.
+                # Existing files are skipped there unless overwrite is set.
+                data = b"".join(
+                    rec.raw().str() for rec in request_item.data[comp])
+                self.write_queue.put((mseed_filename, data, overwrite))
 
             # Dump pick to XML
-            xml_filename = str(path / "pick.xml")
-            ep = seiscomp.datamodel.EventParameters()
-            ep.add(request_item.pick)
-            ar = seiscomp.io.XMLArchive()
-            ar.setFormattedOutput(True)
-            ar.create(xml_filename)
-            ar.writeObject(ep)
-            ar.close()
+            xml_filename = path / "pick.xml"
+            self.xml_pending.append((xml_filename, request_item.pick))
 
-        # Count items still in the request queue
-        count_1 = len(self.request)
-        count_2 = 0
-        for nslc in self.request_by_nslc:
-            count_2 += len(self.request_by_nslc[nslc])
-        assert count_1 == count_2
-        seiscomp.logging.debug("Pending %d items" % (count_1,))
+        # Every pending request is awaited either from the archive or
+        # from the stream buffer
+        count = len(self.request)
+        assert count == len(self.archive_pending) + self.request_by_nslc_count
+        seiscomp.logging.debug("Pending %d items" % (count,))
 
     def processPick(self, pick):
         """
         For the pick, setup a RequestItem and add it to the active requests.
         """
-        seiscomp.logging.debug("pick %s" % (pick.publicID(),))
         pickID = pick.publicID()
+        seiscomp.logging.debug("pick %s" % (pickID,))
         n, s, l, c = scstuff.util.nslc(pick.waveformID())
-        nslc = (n, s, "--" if l=="" else l, c[:2])
+        if not c:
+            seiscomp.logging.debug(
+                "skipping pick %s without channel code" % (pickID,))
+            return
+        nslc, comp = stream_key(n, s, l, c)
 
         t0 = pick.time().value()
-        t1 = t0 + TimeSpan(-self.before_p)
-        t2 = t0 + TimeSpan(+self.after_p)
+        t1 = t0 + self.before_p_span
+        t2 = t0 + self.after_p_span
         if nslc not in self.components:
             # This may occur if a station was (1) blacklisted or (2) added
             # to the processing later on. Either way we skip this pick.
             return
 
-        now = Time.GMT()
-        request_item = RequestItem()
-        request_item.expires = now + TimeSpan(self.expire_after)
-        request_item.pick = pick
-        request_item.nslc = nslc
-        request_item.components = self.components[nslc]
-        request_item.start_time = t1
-        request_item.end_time = t2
+        now = float(Time.GMT())
+        request_item = RequestItem(
+            pick, nslc, self.components[nslc], t1, t2,
+            now + self.expire_after)
         self.request[pickID] = request_item
-        if nslc not in self.request_by_nslc:
-            self.request_by_nslc[nslc] = list()
-        self.request_by_nslc[nslc].append(request_item)
 
-        # For older picks we fetch the data directly from the archive
-        if nslc not in self.end_time:
+        # For older picks we fetch the data directly from the archive.
+        # These are processed once the archive data have been retrieved
+        # and are not added to the requests completed from the buffer.
+        if nslc not in self.buffer or self.buffer[nslc].min_end_time is None:
             # This may be the case if the station is currently not producing
             # data but we want to work with older data that we possibly find
             # in the archive.
-            # In this case we don't know the acquisition status (nslc is not
-            # in self.end_time) and can only try to get the data from the
+            # In this case we don't know the acquisition status (no records
+            # received for nslc) and can only try to get the data from the
             # archive.
-            self.fetchArchiveData(request_item)
-
+            self.archive_pending.append(request_item)
+        elif request_item.end_seconds < self.buffer[nslc].min_end_time - 0.5*self.buffer_length:
+            # The end time of our time window of interest is well behind
+            # our acquisition end time
+            self.archive_pending.append(request_item)
         else:
-            # If the end time of our time window of interest is well behind our
-            # acquisition end time
-            if request_item.end_time < min(self.end_time[nslc].values()) - TimeSpan(0.5*self.buffer_length):
-                self.fetchArchiveData(request_item)
+            self.request_serial += 1
+            heapq.heappush(
+                self.request_by_nslc[nslc],
+                (request_item.end_seconds, self.request_serial, request_item))
+            self.request_by_nslc_count += 1
 
     def addObject(self, parentID, obj):
         # called if a new object is received
@@ -441,6 +719,31 @@ class PickWaveformDumperApp(BufferingStreamApplication):
         if pick:
             self.processPick(pick)
 
+    def flushPickXML(self):
+        """
+        Write all pending picks to their XML files.
+        """
+        ep = self.xml_ep
+        ar = self.xml_archive
+        for xml_filename, pick in self.xml_pending:
+            xml_filename.parent.mkdir(parents=True, exist_ok=True)
+            ep.add(pick)
+            ar.create(str(xml_filename))
+            ar.writeObject(ep)
+            ar.close()
+            ep.remove(pick)
+        self.xml_pending = list()
+
+    def handleTimeout(self):
+        # The timeout interval can be configured via archive_flush_interval
+        self.flushArchiveRequests()
+        self.flushPickXML()
+
+    def run(self):
+        self.enableTimer(self.archive_flush_interval)
+        return super().run()
+
+
 def main():
     app = PickWaveformDumperApp(len(sys.argv), sys.argv)
     app()